@@ -1,3 +1,4 @@
+import asyncio
 import numpy as np
 import torch
 import torch.nn as nn
@@ -6,43 +7,107 @@ import torchvision.transforms as transforms
 import base64
 import io
 import nibabel as nib
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
 from PIL import Image
 import os
 import sys
 import uvicorn
-import tempfile
+import gzip
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    import onnx
+    import onnxruntime as ort
+except ImportError:
+    onnx = None
+    ort = None
 
 IMAGE_SIZE = (224, 224)
+HU_MIN, HU_MAX = -1000.0, 400.0  # CT intensity window the model was trained on
+OVERLAY_COLOR = np.array([255, 0, 0], dtype=np.uint8)  # tumor pixels in the overlay image
 MODEL_PATH = r"D:\Programming\Uni\Image Processing\Project\liver_tumor_segmentation\server\model\unet_best_epoch28_dice0.9688.pth"
-
-def load_nifti_bytes(data: bytes, original_filename: str):
+ONNX_PATH = os.path.splitext(MODEL_PATH)[0] + ".onnx"
+ONNX_FP16_PATH = os.path.splitext(MODEL_PATH)[0] + "_fp16.onnx"
+# "onnx" serves the exported graph with ONNX Runtime, "torch" keeps the eager UNet.
+# On a GPU host "onnx" is only used when onnxruntime-gpu provides the CUDA
+# execution provider; with the CPU-only onnxruntime wheel the PyTorch CUDA path
+# is used instead so the GPU is not left idle.
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "onnx").lower()
+# Applied to the PyTorch backend only: "int8" (CPU post-training quantization),
+# "jit" (traced, frozen FP32 TorchScript), "compile" (torch.compile) or "none".
+# "int8" falls back to "jit" when no calibration data is available. Both are
+# CPU-only; on CUDA they are replaced by "compile" on the channels_last bf16 model.
+TORCH_OPTIMIZATION = os.environ.get("TORCH_OPTIMIZATION", "int8").lower()
+# NIfTI volumes whose middle slices calibrate the INT8 activation ranges.
+CALIBRATION_DIR = os.path.join(os.path.dirname(MODEL_PATH), "calibration")
+CALIBRATION_SLICES = 50
+# Concurrent /predict/slice requests are grouped into batches of at most this size.
+MAX_BATCH_SIZE = 16
+BATCH_TIMEOUT = 0.01  # seconds after the first request before a partial batch runs
+VOLUME_BATCH_SIZE = 32  # axial slices per forward pass in /predict/volume
+BUFFER_BATCH_SIZE = max(MAX_BATCH_SIZE, VOLUME_BATCH_SIZE)
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def open_nifti_bytes(data: bytes, original_filename: str) -> nib.Nifti1Image:
     """
-    Load NIfTI data from bytes buffer.
-    Nibabel requires a physical file path, so we use a temporary file.
+    Open NIfTI data from a bytes buffer without touching the disk.
+    The returned image keeps an array proxy, so voxels are only decoded when sliced.
     """
+    fileobj = io.BytesIO(data)
+    if original_filename.lower().endswith(".gz"):
+        fileobj = gzip.GzipFile(fileobj=fileobj)
+    fh = nib.FileHolder(fileobj=fileobj)
+    return nib.Nifti1Image.from_file_map({"header": fh, "image": fh})
 
-    suffix = ".nii.gz" if original_filename.lower().endswith(".nii.gz") else ".nii"
+def load_nifti_image(data: bytes, original_filename: str):
+    """
+    Load the full NIfTI volume from a bytes buffer.
+    :return: (volume array, image) - the image carries the affine and header.
+    """
+    img = open_nifti_bytes(data, original_filename)
+    data_arr = np.asanyarray(img.dataobj)
+    if data_arr.ndim == 4:
+        data_arr = data_arr.squeeze()
+    return data_arr, img
 
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
-        tmp.write(data)
-        tmp_path = tmp.name
+def load_nifti_bytes(data: bytes, original_filename: str):
+    """Load the full NIfTI volume from a bytes buffer."""
+    return load_nifti_image(data, original_filename)[0]
 
-    try:
-        img = nib.load(tmp_path)
-        data_arr = np.asanyarray(img.dataobj)
-        if data_arr.ndim == 4:
-            data_arr = data_arr.squeeze()
-        return data_arr
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+def load_nifti_middle_slice(data: bytes, original_filename: str) -> np.ndarray:
+    """Decode only the middle axial slice (first volume of a 4D series) from a bytes buffer."""
+    img = open_nifti_bytes(data, original_filename)
+    index = (slice(None), slice(None), img.shape[2] // 2) + (0,) * (len(img.shape) - 3)
+    return np.asanyarray(img.dataobj[index])
 
 def normalize_volume(volume: np.ndarray) -> np.ndarray:
-    volume = np.clip(volume, -1000, 400)
-    volume = (volume - volume.min()) / (volume.max() - volume.min() + 1e-8)
-    return volume.astype(np.float32)
+    """
+    Clip to the [HU_MIN, HU_MAX] window and scale to [0, 1] as float32.
+    The window is fixed, so no min/max reduction is needed and numexpr does
+    the whole thing in one streamed pass.
+    """
+    out = np.empty(volume.shape, dtype=np.float32)
+    if ne is not None:
+        return ne.evaluate("(where(v < lo, lo, where(v > hi, hi, v)) - lo) / (hi - lo)",
+                           local_dict={"v": volume, "lo": HU_MIN, "hi": HU_MAX},
+                           out=out, casting="unsafe")
+    np.clip(volume, HU_MIN, HU_MAX, out=out)
+    out -= HU_MIN
+    out /= HU_MAX - HU_MIN
+    return out
 
 # --- 2) U-Net Model Definition ---
 class DoubleConv(nn.Module):
@@ -114,6 +179,20 @@ class UNet(nn.Module):
 
 # --- 3) Model Loading ---
 
+def _physical_cores() -> int:
+    """Physical core count; hyper-threads only add contention to conv kernels."""
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count()
+    except ImportError:
+        return os.cpu_count()
+
+# One core is left to the event loop and request decoding; inter-op parallelism
+# only oversubscribes the cores the conv kernels already use.
+INFERENCE_THREADS = max(1, _physical_cores() - 1)
+torch.set_num_threads(INFERENCE_THREADS)
+torch.set_num_interop_threads(1)
+
 try:
     model = UNet(n_channels=1, n_classes=1, base_c=32) 
     checkpoint = torch.load(MODEL_PATH, map_location=torch.device('cpu'))
@@ -128,68 +207,498 @@ except Exception as e:
     model = None
 
 
-# --- 4) API Utility Functions ---
+# --- 3b) ONNX Runtime Session ---
 
-def image_to_base64(img: Image.Image) -> str:
-    """Convert PIL Image to base64 string."""
-    buffer = io.BytesIO()
+def _is_up_to_date(path: str) -> bool:
+    """True if `path` exists and was written after the checkpoint it was derived from."""
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(MODEL_PATH)
 
-    if img.mode == 'L' or img.mode == 'F':
-        img.save(buffer, format="PNG")
+def build_onnx_session(model: nn.Module):
+    """
+    Export the UNet to ONNX (once, cached next to the checkpoint) and open an
+    ONNX Runtime session on it.
+    The FP16 graph is only used with the CUDA provider; the CPU provider has
+    no FP16 Conv kernels and would insert casts around every layer.
+    A listed CUDA provider only means the wheel was built with it, so the FP16
+    session is checked after opening and reopened on the FP32 graph if ORT
+    fell back to the CPU.
+    """
+    available = ort.get_available_providers()
+    use_fp16 = "CUDAExecutionProvider" in available and DEVICE.type == "cuda"
+
+    if not _is_up_to_date(ONNX_PATH):
+        torch.onnx.export(
+            model, torch.randn(1, 1, *IMAGE_SIZE), ONNX_PATH,
+            opset_version=17,
+            input_names=["x"], output_names=["logits"],
+            dynamic_axes={"x": {0: "b"}, "logits": {0: "b"}},
+            dynamo=False,
+        )
+    if use_fp16 and not _is_up_to_date(ONNX_FP16_PATH):
+        from onnxconverter_common import float16
+        onnx.save(float16.convert_float_to_float16(onnx.load(ONNX_PATH)), ONNX_FP16_PATH)
+
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.intra_op_num_threads = INFERENCE_THREADS
+    opts.inter_op_num_threads = 1
+    providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+    session = ort.InferenceSession(ONNX_FP16_PATH if use_fp16 else ONNX_PATH,
+                                   sess_options=opts, providers=providers)
+    if use_fp16 and session.get_providers()[0] != "CUDAExecutionProvider":
+        sys.stderr.write("WARNING: CUDA execution provider unavailable, serving the FP32 ONNX graph on CPU.\n")
+        session = ort.InferenceSession(ONNX_PATH, sess_options=opts, providers=["CPUExecutionProvider"])
+    return session
+
+session = None
+if model is not None and INFERENCE_BACKEND == "onnx":
+    if ort is None:
+        sys.stderr.write("WARNING: onnxruntime is not installed. Falling back to PyTorch inference.\n")
+    elif DEVICE.type == "cuda" and "CUDAExecutionProvider" not in ort.get_available_providers():
+        print("onnxruntime has no CUDA execution provider; serving the PyTorch model on the GPU instead")
     else:
-        img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode()
+        try:
+            session = build_onnx_session(model)
+            print(f"ONNX Runtime session ready ({session.get_providers()[0]})")
+        except Exception as e:
+            sys.stderr.write(f"WARNING: Could not build ONNX Runtime session, falling back to PyTorch. Details: {e}\n")
+            session = None
+
+# --- 3c) Graph Optimization (PyTorch backend) ---
+
+def resize_planes(planes: torch.Tensor) -> torch.Tensor:
+    """
+    Bilinearly resize (N, 1, H, W) normalized slices to (N, 1, *IMAGE_SIZE) model inputs.
+    Antialiasing keeps downscaling equivalent to the PIL BILINEAR filter used before.
+    """
+    return F.interpolate(planes, size=IMAGE_SIZE, mode="bilinear", align_corners=False, antialias=True)
+
+def resize_slice(slice_tensor: torch.Tensor) -> torch.Tensor:
+    """Resize a normalized (H, W) slice tensor to a (1, *IMAGE_SIZE) model input."""
+    return resize_planes(slice_tensor[None, None])[0]
+
+def load_calibration_slices(directory: str, limit: int) -> list:
+    """Middle slices of the NIfTI volumes in `directory` as (1, *IMAGE_SIZE) tensors."""
+    if not os.path.isdir(directory):
+        return []
+    slices = []
+    for name in sorted(os.listdir(directory)):
+        if len(slices) >= limit:
+            break
+        if not name.lower().endswith((".nii", ".nii.gz")):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            vol = normalize_volume(load_nifti_bytes(f.read(), name))
+        slices.append(resize_slice(torch.from_numpy(vol[:, :, vol.shape[2] // 2])))
+    return slices
+
+def quantize_int8(model: nn.Module, calibration_slices: list) -> torch.jit.ScriptModule:
+    """
+    Post-training static INT8 quantization in FX graph mode for the fbgemm backend.
+    prepare_fx folds every BatchNorm into its Conv; the converted graph is
+    scripted and frozen so weights are inlined as constants.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = "fbgemm"
+    example = torch.zeros(1, 1, *IMAGE_SIZE)
+    prepared = prepare_fx(model, get_default_qconfig_mapping("fbgemm"), example_inputs=(example,))
+    with torch.no_grad():
+        for calib in calibration_slices:
+            prepared(calib.unsqueeze(0))
+    qmodel = convert_fx(prepared)
+    return torch.jit.freeze(torch.jit.script(qmodel).eval())
+
+def freeze_jit(model: nn.Module) -> torch.jit.ScriptModule:
+    """
+    Trace the FP32 UNet (its forward is shape-static), freeze it and run
+    optimize_for_inference so BatchNorm/ReLU are folded into the convolutions.
+    """
+    torch._C._jit_set_profiling_executor(False)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.zeros(1, 1, *IMAGE_SIZE))
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+if model is not None and session is None and DEVICE.type == "cuda":
+    model = model.to(DEVICE, memory_format=torch.channels_last)
+    print(f"Model moved to {torch.cuda.get_device_name(DEVICE)}")
+    if TORCH_OPTIMIZATION in ("int8", "jit"):
+        TORCH_OPTIMIZATION = "compile"
 
-def array_to_base64(arr: np.ndarray, is_mask=False) -> str:
-    """Convert 2D numpy array (image or mask) to base64 PNG."""
+if model is not None and session is None and DEVICE.type == "cpu" and TORCH_OPTIMIZATION == "int8":
+    try:
+        calibration = load_calibration_slices(CALIBRATION_DIR, CALIBRATION_SLICES)
+        if not calibration:
+            sys.stderr.write(f"WARNING: No calibration volumes found in {CALIBRATION_DIR}. Serving the FP32 model.\n")
+            TORCH_OPTIMIZATION = "jit"
+        else:
+            model = quantize_int8(model, calibration)
+            print(f"Model quantized to INT8 using {len(calibration)} calibration slices")
+    except Exception as e:
+        sys.stderr.write(f"WARNING: INT8 quantization failed, serving the FP32 model. Details: {e}\n")
+        TORCH_OPTIMIZATION = "jit"
+
+if model is not None and session is None and DEVICE.type == "cpu" and TORCH_OPTIMIZATION == "jit":
+    try:
+        model = freeze_jit(model)
+        print("Model traced and frozen with TorchScript")
+    except Exception as e:
+        sys.stderr.write(f"WARNING: TorchScript freezing failed, serving the eager model. Details: {e}\n")
+
+# Compiled graphs are specialized to a fixed input shape, so batches are padded
+# up to one of these sizes and each one is compiled once during warm-up.
+BATCH_BUCKETS = [1 << i for i in range(BUFFER_BATCH_SIZE.bit_length()) if 1 << i <= BUFFER_BATCH_SIZE]
+_eager_model = model
+_compiled = False
+if model is not None and session is None and TORCH_OPTIMIZATION == "compile":
+    # CUDA graphs remove per-layer launch overhead on the GPU; on the CPU
+    # max-autotune lets Inductor pick packed oneDNN convolutions.
+    model = torch.compile(model, mode="reduce-overhead" if DEVICE.type == "cuda" else "max-autotune",
+                          dynamic=False)
+    _compiled = True
+
+
+# Preallocated NCHW input/output buffers, typed to whatever the session expects (float16 on CUDA).
+_ort_input = None
+_ort_output = None
+if session is not None:
+    _ort_dtype = np.float16 if session.get_inputs()[0].type == "tensor(float16)" else np.float32
+    _ort_input = np.empty((BUFFER_BATCH_SIZE, 1, *IMAGE_SIZE), dtype=_ort_dtype)
+    _ort_out_dtype = np.float16 if session.get_outputs()[0].type == "tensor(float16)" else np.float32
+    _ort_output = np.empty((BUFFER_BATCH_SIZE, 1, *IMAGE_SIZE), dtype=_ort_out_dtype)
+    _ort_device = "cuda" if session.get_providers()[0] == "CUDAExecutionProvider" else "cpu"
+
+# IOBindings per batch size, created on first use and reused for every later batch.
+_ort_bindings = {}
+
+def ort_binding(batch_size: int):
+    """
+    Return (io_binding, input OrtValue, output OrtValue) for `batch_size`.
+    The output always wraps _ort_output, so logits land in that host buffer
+    (ORT copies them there from the GPU). On CPU the input wraps _ort_input
+    as well; on CUDA it is a device tensor allocated once.
+    """
+    if batch_size not in _ort_bindings:
+        shape = [batch_size, 1, *IMAGE_SIZE]
+        if _ort_device == "cpu":
+            in_ort = ort.OrtValue.ortvalue_from_numpy(_ort_input[:batch_size])
+        else:
+            in_ort = ort.OrtValue.ortvalue_from_shape_and_type(shape, _ort_input.dtype, "cuda", 0)
+        out_ort = ort.OrtValue.ortvalue_from_numpy(_ort_output[:batch_size])
+        io_binding = session.io_binding()
+        io_binding.bind_ortvalue_input("x", in_ort)
+        io_binding.bind_ortvalue_output("logits", out_ort)
+        _ort_bindings[batch_size] = (io_binding, in_ort, out_ort)
+    return _ort_bindings[batch_size]
+
+# Slices are resized where the model runs: on the GPU for the CUDA PyTorch
+# backend, so only the raw slice goes up and the final mask comes back down.
+_resize_device = DEVICE if session is None else torch.device("cpu")
+if _ort_input is not None and _ort_input.dtype == np.float32:
+    # Resized slices land directly in the array handed to ONNX Runtime.
+    _input_batch = torch.from_numpy(_ort_input)
+else:
+    _input_batch = torch.empty((BUFFER_BATCH_SIZE, 1, *IMAGE_SIZE), dtype=torch.float32, device=_resize_device)
+# Logits are thresholded straight into this buffer, so no per-request tensors are allocated.
+_mask_batch = torch.empty((BUFFER_BATCH_SIZE, 1, *IMAGE_SIZE), dtype=torch.bool, device=_resize_device)
+
+
+# --- 4) API Utility Functions ---
+
+def image_to_png(img: Image.Image) -> bytes:
+    """Encode PIL Image as PNG. Level 1 DEFLATE: masks and overlays compress well regardless."""
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+def array_to_png(arr: np.ndarray, is_mask=False) -> bytes:
+    """Convert 2D numpy array (image or mask) to PNG bytes."""
     if is_mask:
-        # For masks (0 or 1), scale to 0/255 for better visual output
-        img = Image.fromarray((arr * 255).astype(np.uint8), mode='L')
+        # For masks (0 or 1), write a bilevel PNG: one bit per pixel, decoded as 0/255
+        bits = np.packbits(arr.astype(bool), axis=1)
+        img = Image.frombytes('1', (arr.shape[1], arr.shape[0]), bits.tobytes())
     else:
         # For normalized image arrays (0-255 uint8)
         if arr.dtype == np.float32 and arr.max() <= 1.01:
              arr = (arr * 255).astype(np.uint8)
         img = Image.fromarray(arr, mode='L')
         
-    return image_to_base64(img)
+    return image_to_png(img)
+
+def norm_to_uint8(arr: np.ndarray) -> np.ndarray:
+    """Scale a [0, 1] float array to uint8 in one pass (the cast happens inside the multiply)."""
+    return np.multiply(arr, 255, out=np.empty(arr.shape, dtype=np.uint8), casting="unsafe")
+
+def make_overlay(gray: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    RGB overlay of a uint8 grayscale image with mask pixels painted OVERLAY_COLOR.
+    The grayscale channel is broadcast rather than stacked, so the (H, W, 3)
+    result is written in a single pass.
+    """
+    return np.where(mask.view(bool)[..., None], OVERLAY_COLOR, gray[..., None])
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered by orjson, which writes bytes directly from its C core."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+DefaultResponse = ORJSONResponse if orjson is not None else JSONResponse
+
+def accept_quality(request: Request, media_type: str, wildcards=True) -> float:
+    """
+    q-value the Accept header gives `media_type` (0 if not acceptable).
+    The most specific matching range wins; with `wildcards=False` only an
+    explicit listing counts. A missing header accepts everything.
+    """
+    header = request.headers.get("accept")
+    if not header:
+        return 1.0 if wildcards else 0.0
+    main_type = media_type.split("/")[0]
+    candidates = [media_type] + ([f"{main_type}/*", "*/*"] if wildcards else [])
+    qualities = {}
+    for media_range in header.split(","):
+        name, *params = [p.strip() for p in media_range.split(";")]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[name.lower()] = q
+    for candidate in candidates:
+        if candidate in qualities:
+            return qualities[candidate]
+    return 0.0
+
+def build_response(request: Request, images: dict) -> Response:
+    """
+    Return the named PNG images in the format the client accepts:
+    - "multipart/mixed" listed explicitly, with a q-value at least that of
+      application/json: one raw image/png part per image,
+    - anything else: JSON with base64-encoded PNGs.
+    """
+    multipart_q = accept_quality(request, "multipart/mixed", wildcards=False)
+    if multipart_q > 0 and multipart_q >= accept_quality(request, "application/json"):
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for name, png in images.items():
+            body.write(f"--{boundary}\r\n"
+                       f"Content-Type: image/png\r\n"
+                       f"Content-Disposition: attachment; name=\"{name}\"; filename=\"{name}.png\"\r\n\r\n".encode())
+            body.write(png)
+            body.write(b"\r\n")
+        body.write(f"--{boundary}--\r\n".encode())
+        return Response(content=body.getvalue(), media_type=f"multipart/mixed; boundary={boundary}")
+    return DefaultResponse(content={name: base64.b64encode(png).decode() for name, png in images.items()})
+
+
+def _batch_bucket(batch_size: int) -> int:
+    """Smallest entry of BATCH_BUCKETS that fits `batch_size`."""
+    return next(b for b in BATCH_BUCKETS if b >= batch_size)
+
+def torch_forward(input_tensor: torch.Tensor) -> torch.Tensor:
+    """Forward pass of the PyTorch model (channels_last + bf16 autocast on CUDA)."""
+    if DEVICE.type == "cuda":
+        input_tensor = input_tensor.contiguous(memory_format=torch.channels_last)
+    model.eval()
+    with torch.no_grad(), torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16,
+                                         enabled=DEVICE.type == "cuda"):
+        return model(input_tensor)
 
+def warm_up():
+    """
+    Compile every batch bucket ahead of the first request (two passes each, so
+    CUDA graphs are recorded as well). Falls back to the uncompiled model on failure.
+    """
+    global model, _compiled
+    if not _compiled:
+        return
+    try:
+        for size in BATCH_BUCKETS:
+            for _ in range(2):
+                torch_forward(_input_batch[:size].zero_())
+        print(f"Model compiled for batch sizes {BATCH_BUCKETS}")
+    except Exception as e:
+        sys.stderr.write(f"WARNING: torch.compile failed, serving the uncompiled model. Details: {e}\n")
+        model = _eager_model
+        _compiled = False
+
+def forward_batch(batch_size: int) -> torch.Tensor:
+    """
+    Runs the model on the first `batch_size` resized slices in _input_batch.
+    :return: (batch_size, 1, *IMAGE_SIZE) tensor of 0/1 predictions (uint8), on _resize_device.
+    """
+    if session is not None:
+        if _ort_input.dtype != np.float32:
+            _ort_input[:batch_size] = _input_batch[:batch_size].numpy()
+        io_binding, in_ort, _ = ort_binding(batch_size)
+        if _ort_device == "cuda":
+            in_ort.update_inplace(_ort_input[:batch_size])
+        session.run_with_iobinding(io_binding)
+        logits = torch.from_numpy(_ort_output[:batch_size])
+    else:
+        forward_size = _batch_bucket(batch_size) if _compiled else batch_size
+        logits = torch_forward(_input_batch[:forward_size])[:batch_size]
+
+    # sigmoid(x) > 0.5 <=> x > 0: threshold the logits directly.
+    mask_preds = _mask_batch[:batch_size]
+    torch.gt(logits, 0, out=mask_preds)
+    return mask_preds.view(torch.uint8)
 
-def run_model(slice_array: np.ndarray, original_shape: tuple) -> np.ndarray:
+def run_batch(slices: list) -> list:
     """
-    Runs segmentation on a single, normalized 2D slice.
-    :param slice_array: 2D numpy array (float32, [0, 1])
-    :param original_shape: (H, W) of the input slice for mask resizing.
-    :return: 2D numpy array of the mask (float32, 0 or 1) resized to original_shape.
+    Runs segmentation on a batch of normalized 2D slices in one forward pass.
+    :param slices: list of 2D numpy arrays (float32, [0, 1]); shapes may differ.
+    :return: list of 2D masks (uint8, 0 or 1), each resized to its slice's shape.
     """
     if model is None:
         raise RuntimeError("Model is not loaded.")
 
-    img_pil = Image.fromarray(slice_array)
-    img_resized = img_pil.resize(IMAGE_SIZE, Image.BILINEAR)
-    img_np_resized = np.array(img_resized)
+    for i, slice_array in enumerate(slices):
+        _input_batch[i] = resize_slice(torch.from_numpy(slice_array).to(_resize_device))
+    mask_preds = forward_batch(len(slices))
 
-    input_tensor = torch.from_numpy(img_np_resized).unsqueeze(0).unsqueeze(0).float()
-    
-    model.eval()
     with torch.no_grad():
-        output = model(input_tensor) 
-        
-        mask_probs = torch.sigmoid(output) 
-        mask_preds = (mask_probs > 0.5).float() 
+        masks = []
+        for mask_pred, slice_array in zip(torch.split(mask_preds, 1), slices):
+            mask = F.interpolate(mask_pred, size=slice_array.shape, mode="nearest-exact")
+            masks.append(mask[0, 0].cpu().numpy())
+    return masks
+
+def run_slab(slab: np.ndarray) -> np.ndarray:
+    """
+    Runs segmentation on consecutive axial slices of a normalized volume in one forward pass.
+    :param slab: (H, W, N) numpy array (float32, [0, 1]) with N <= VOLUME_BATCH_SIZE.
+    :return: (H, W, N) uint8 mask (0 or 1).
+    """
+    if model is None:
+        raise RuntimeError("Model is not loaded.")
+
+    n = slab.shape[2]
+    planes = torch.from_numpy(np.moveaxis(slab, 2, 0)).unsqueeze(1).to(_resize_device)
+    _input_batch[:n] = resize_planes(planes)
+    mask_preds = forward_batch(n)
+
+    with torch.no_grad():
+        masks = F.interpolate(mask_preds, size=slab.shape[:2], mode="nearest-exact")
+        return np.moveaxis(masks[:, 0].cpu().numpy(), 0, 2)
+
+
+# --- 5) Inference Worker ---
+
+# torch and ONNX Runtime sessions are not shared across threads; every forward
+# pass runs on this one thread so the event loop never blocks on inference.
+_inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+async def server_loop(queue: asyncio.Queue):
+    """
+    Consumes (slice, future) pairs from `queue`, groups whatever arrives within
+    BATCH_TIMEOUT of the first item (up to MAX_BATCH_SIZE) into one batch and
+    resolves each request's future with its mask.
+    Requests already waiting are drained without yielding; the loop only
+    suspends when the queue is empty and the deadline has not passed.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await queue.get()]
+        deadline = loop.time() + BATCH_TIMEOUT
+        while len(items) < MAX_BATCH_SIZE:
+            try:
+                items.append(queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            masks = await loop.run_in_executor(_inference_executor, run_batch, [s for s, _ in items])
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        for (_, future), mask in zip(items, masks):
+            if not future.done():
+                future.set_result(mask)
+
+async def segment_slice(slice_array: np.ndarray) -> np.ndarray:
+    """Queue a normalized 2D slice for the inference worker and wait for its mask."""
+    future = asyncio.get_running_loop().create_future()
+    await app.state.queue.put((slice_array, future))
+    return await future
+
+async def segment_to_response(request: Request, gray: np.ndarray, norm: np.ndarray, image_key: str) -> Response:
+    """
+    Segment a slice and build the image/mask/overlay response.
+    :param gray: the slice as a uint8 grayscale image, returned under `image_key`.
+    :param norm: the same slice normalized to float32 [0, 1], fed to the model.
+    """
+    mask = await segment_slice(norm)
+    images = await asyncio.to_thread(encode_outputs, gray, mask, image_key)
+    return build_response(request, images)
+
+def encode_outputs(gray: np.ndarray, mask: np.ndarray, image_key: str) -> dict:
+    """PNG-encode the input slice, mask and overlay (blocking; runs off the event loop)."""
+    return {
+        image_key: array_to_png(gray),
+        "mask": array_to_png(mask, is_mask=True),
+        "overlay": image_to_png(Image.fromarray(make_overlay(gray, mask))),
+    }
+
+async def segment_volume(vol_norm: np.ndarray) -> np.ndarray:
+    """
+    Segment every axial slice of a normalized (H, W, Z) volume, VOLUME_BATCH_SIZE
+    slices per forward pass. Each slab is a separate job on the inference thread,
+    so queued slice requests are not stuck behind a whole volume.
+    """
+    loop = asyncio.get_running_loop()
+    mask = np.empty(vol_norm.shape, dtype=np.uint8)
+    for start in range(0, vol_norm.shape[2], VOLUME_BATCH_SIZE):
+        stop = min(start + VOLUME_BATCH_SIZE, vol_norm.shape[2])
+        mask[:, :, start:stop] = await loop.run_in_executor(_inference_executor, run_slab,
+                                                            vol_norm[:, :, start:stop])
+    return mask
+
+def mask_to_nifti_bytes(mask: np.ndarray, img: nib.Nifti1Image) -> bytes:
+    """
+    Serialize a uint8 mask volume as .nii.gz bytes in the space of the input scan.
+    The input header is reused so qform/sform codes and units carry over.
+    """
+    mask_img = nib.Nifti1Image(mask, img.affine, header=img.header)
+    mask_img.set_data_dtype(np.uint8)
+    mask_img.header.set_slope_inter(1, 0)
+    return gzip.compress(mask_img.to_bytes(), compresslevel=1)
 
-    mask_np_resized = mask_preds.squeeze().cpu().numpy() 
+def decode_image(data: bytes) -> Image.Image:
+    """Decode uploaded PNG/JPEG bytes to a grayscale PIL image."""
+    return Image.open(io.BytesIO(data)).convert("L")
 
-    mask_np_original_size = np.array(Image.fromarray(mask_np_resized).resize(
-        (original_shape[1], original_shape[0]), Image.NEAREST
-    ))
 
-    return mask_np_original_size
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up on the inference thread itself: CUDA graphs are recorded per thread.
+    await asyncio.get_running_loop().run_in_executor(_inference_executor, warm_up)
+    app.state.queue = asyncio.Queue()
+    worker = asyncio.create_task(server_loop(app.state.queue))
+    yield
+    worker.cancel()
 
 
-app = FastAPI(title="Image Segmentation API")
+app = FastAPI(title="Image Segmentation API", lifespan=lifespan, default_response_class=DefaultResponse)
 
 @app.post("/predict/slice")
-async def predict_slice(image: UploadFile = File(...)):
+async def predict_slice(request: Request, image: UploadFile = File(...)):
     if model is None:
         raise HTTPException(status_code=503, detail="Model service is currently unavailable.")
         
@@ -198,68 +707,55 @@ async def predict_slice(image: UploadFile = File(...)):
 
     if filename.endswith((".png", ".jpg", ".jpeg")):
         try:
-            pil_image = Image.open(io.BytesIO(data)).convert("L") 
-            original_shape = pil_image.size[::-1] 
+            pil_image = await asyncio.to_thread(decode_image, data)
             
             image_array_uint8 = np.array(pil_image)
-            image_array_norm = image_array_uint8.astype(np.float32) / 255.0
-            
-            mask = run_model(image_array_norm, original_shape)
+            image_array_norm = np.divide(image_array_uint8, 255, dtype=np.float32)
 
-            overlay_image = np.stack([image_array_uint8] * 3, axis=-1) 
-            
-            mask_indices = mask == 1
-            overlay_image[mask_indices] = [255, 0, 0] 
-
-            # Convert outputs to base64
-            mask_64 = array_to_base64(mask, is_mask=True)
-            overlay_64 = image_to_base64(Image.fromarray(overlay_image.astype(np.uint8)))
-
-            return JSONResponse(content={
-                "original_image": array_to_base64(image_array_uint8),
-                "mask": mask_64,
-                "overlay": overlay_64,
-            })
+            return await segment_to_response(request, image_array_uint8, image_array_norm, "original_image")
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error processing 2D image: {e}")
 
     elif filename.endswith((".nii", ".nii.gz")):
         try:
-            vol = load_nifti_bytes(data, filename)
-            vol_norm = normalize_volume(vol) 
-
-            z_dim = vol_norm.shape[2]
-            middle_slice_index = z_dim // 2
-            mid_slice_norm = vol_norm[:, :, middle_slice_index] 
-            original_shape = mid_slice_norm.shape 
-
-            mask = run_model(mid_slice_norm, original_shape)
-            
-            mid_uint8 = (mid_slice_norm * 255).astype(np.uint8)
-
-            overlay_image = np.stack([mid_uint8] * 3, axis=-1) 
-            mask_indices = mask == 1
-            overlay_image[mask_indices] = [255, 0, 0] 
-
-            mask_64 = array_to_base64(mask, is_mask=True)
-            image_64 = array_to_base64(mid_uint8)
-            overlay_64 = image_to_base64(Image.fromarray(overlay_image.astype(np.uint8)))
+            mid_slice = await asyncio.to_thread(load_nifti_middle_slice, data, filename)
+            mid_slice_norm = normalize_volume(mid_slice)
+            mid_uint8 = norm_to_uint8(mid_slice_norm)
 
-            return JSONResponse({
-                "image": image_64,
-                "mask": mask_64,
-                "overlay": overlay_64
-            })
-            
+            return await segment_to_response(request, mid_uint8, mid_slice_norm, "image")
         except Exception as e:
             print(f"Error processing NIfTI file: {e}") 
             raise HTTPException(status_code=500, detail=f"Error processing NIfTI file: {e}")
 
-
-
     else:
         raise HTTPException(status_code=400, detail="Invalid file type. Only PNG, JPG, NII, or NII.GZ are supported.")
 
-if __name__ == "__main__":
+@app.post("/predict/volume")
+async def predict_volume(image: UploadFile = File(...)):
+    """Segment all slices of a NIfTI volume and return the mask volume as .nii.gz."""
+    if model is None:
+        raise HTTPException(status_code=503, detail="Model service is currently unavailable.")
+
+    filename = image.filename.lower()
+    if not filename.endswith((".nii", ".nii.gz")):
+        raise HTTPException(status_code=400, detail="Invalid file type. Only NII or NII.GZ are supported.")
+    data = await image.read()
+
+    try:
+        vol, img = await asyncio.to_thread(load_nifti_image, data, filename)
+        vol_norm = await asyncio.to_thread(normalize_volume, vol)
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+        mask = await segment_volume(vol_norm)
+
+        body = await asyncio.to_thread(mask_to_nifti_bytes, mask, img)
+        return Response(content=body, media_type="application/gzip",
+                        headers={"Content-Disposition": 'attachment; filename="mask.nii.gz"'})
+    except Exception as e:
+        print(f"Error processing NIfTI volume: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing NIfTI volume: {e}")
+
+if __name__ == "__main__":
+    # A single worker process: every extra worker would load its own copy of the
+    # model. Concurrency comes from the batching queue, not process replication.
+    # "auto" picks uvloop/httptools when they are installed.
+    uvicorn.run(app, host="0.0.0.0", port=8000, workers=1, loop="auto", http="auto")
\ No newline at end of file